@@ -22,10 +22,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+# Expects a virtualenv here with lxml and koinenlp installed
 PYTHON3=./bin/python3
 
 source ./bin/activate
 
-for file in First1KGreek/data/tlg0527/*/tlg0527*grc*xml; do
-    $PYTHON3 convert-swete.py --outfile --file "$file" convert 
-done
+$PYTHON3 convert-swete.py --outfile \
+    --batch "First1KGreek/data/tlg0527/*/tlg0527*grc*xml" convert
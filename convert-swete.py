@@ -24,32 +24,54 @@
 # THE SOFTWARE.
 
 import argparse
+import concurrent.futures
+import functools
+import glob
 import koinenlp
+import mmap
+import os
 import re
+import sys
 import unicodedata
-import xml.sax
+from lxml import etree
 
 FILTER_CHARS = ["¶", "[", "]", "§"]
-OUTLINE = "{0}.{1}.{2} {3}\n"
+PREFIX = "{0}.{1}.{2} "
 DEST = "data/{0:02d}.{1}.txt"
+FLUSH_SIZE = 1 << 20
+
+# Strip metacharacters, and shim GREEK ANO TELEIA to MIDDLE DOT
+_FILTER_TABLE = str.maketrans({char: None for char in FILTER_CHARS})
+_FILTER_TABLE[ord("\u0387")] = "\u00b7"
+
+# Spaces to underscores and no parentheses in output filenames
+_TITLE_TABLE = str.maketrans({" ": "_", "(": None, ")": None})
+
+_nfc = unicodedata.normalize
+_is_nfc = unicodedata.is_normalized
+
+# Elements which simply set a handler flag while open
+_ELEMENT_FLAGS = {
+    "text": "in_book",
+    "head": "in_header",
+    "idno": "in_idno",
+    "titleStmt": "in_titlestmt",
+    "title": "in_title",
+}
 
 def get_filename(number, title):
     "Return a nice filename from the given title"
 
-    title = title.replace(" ", "_")
-    parens = ["(", ")"]
-    for paren in parens:
-        title = title.replace(paren, "")
-    dest = DEST.format(number, title.strip())
-    return dest
+    return DEST.format(number, title.translate(_TITLE_TABLE).strip())
 
-class SweteLXX(xml.sax.handler.ContentHandler):
-    "Parser for Swete LXX XML"
+class SweteLXX:
+    "Handler for Swete LXX XML events"
 
     def __init__(self, task, outfile):
         "Initialize varibales"
 
-        self.out_lines = []
+        self.out_buf = bytearray()
+        self.out_fd = None
 
         self.in_book = False
         self.in_header = False
@@ -68,42 +90,68 @@ class SweteLXX(xml.sax.handler.ContentHandler):
         self.current_book = 0
         self.book_title = None
 
+        # Tokens recur constantly, so keep each one's encoded output
+        self.token_cache = {}
+
+        # Encoded PREFIX for the current book, chapter and verse
+        self.prefix_key = None
+        self.prefix_bytes = b""
+
     def unicode_normalize(self, text):
         """Return the given text normalized to Unicode NFC."""
 
-        normalized_text = unicodedata.normalize('NFC', text)
-        return normalized_text
+        # ASCII is always in NFC, and most Greek already is; only build
+        # a new string when the NFC quick check fails
+        if text.isascii() or _is_nfc('NFC', text):
+            return text
+        return _nfc('NFC', text)
+
+    def process_token(self, token):
+        "Return the output lines for the given token, encoded as UTF-8"
+
+        # Filter metacharacters and shim GREEK ANO TELEIA
+        token = token.translate(_FILTER_TABLE)
+        if len(token) < 1:
+            return b""
+
+        # Output only the normalized form
+        if self.task == "convert":
+            return (self.unicode_normalize(token) + "\n").encode('utf-8')
+        elif self.task != "compare":
+            return b""
+
+        # Handle punctuation
+        punct_token = None
+        if koinenlp.remove_punctuation(token) == token[:-1]:
+            punct_token = token[-1]
+            end_token = token[:-1]
+        else:
+            end_token = token
+
+        out_lines = self.unicode_normalize(end_token) + "\n"
+        if punct_token:
+            out_lines += punct_token + "\n"
+        return out_lines.encode('utf-8')
 
     def startElement(self, name, attrs):
         "Actions for encountering open tags"
 
-        if (name == "div" and "subtype" in attrs.getNames()
-            and attrs.getValue("subtype") == "chapter"):
-            self.current_chapter = attrs.getValue("n")
-
-        elif (name == "div" and "subtype" in attrs.getNames()
-            and attrs.getValue("subtype") == "verse"):
-            self.current_verse = attrs.getValue("n")
-
-        elif name == "text":
-            self.in_book = True
-            
-        elif name == "head":
-            self.in_header = True
-
-        elif name == "idno":
-            self.in_idno = True
-
-        elif name == "titleStmt":
-            self.in_titlestmt = True
-
-        elif name == "title":
-            self.in_title = True
+        if name == "div":
+            subtype = attrs.get("subtype")
+            if subtype == "chapter":
+                self.current_chapter = attrs.get("n")
+            elif subtype == "verse":
+                self.current_verse = attrs.get("n")
 
         elif name == "note":
             self.note_depth += 1
             self.in_note = True
 
+        else:
+            flag = _ELEMENT_FLAGS.get(name)
+            if flag is not None:
+                setattr(self, flag, True)
+
     def characters(self, data):
         "Handle text"
 
@@ -112,93 +160,166 @@ class SweteLXX(xml.sax.handler.ContentHandler):
         # Probably fragile, this should be done more programmatically
         if self.in_idno:
             self.current_book = int(data[11:14])
+            return
 
         # Obtain the book name
         if self.in_titlestmt and self.in_title:
             self.book_title = data
-
-        # If in the book not in a header, and not in a note
-        if self.in_book and not self.in_note and not self.in_header:
-            tokens = data.split()
-            for token in tokens:
-
-                # If the given token ends with a hyphen, assume a
-                # token split by a linebreak.  Store it in
-                # self.lb_token and continue to the next iteration
-                if token[-1] == "-":
-                    self.lb_token = token[:-1]
-                    continue
-
-                # If there is a lb_token (from a line-break) waiting,
-                # prepend it to the current token before processing
-                if self.lb_token:
-                    token = self.lb_token + token
-                    self.lb_token = None
-
-                # Filter metacharacters
-                for char in FILTER_CHARS:
-                    token = token.replace(char, "")
-                if len(token) < 1:
-                    continue
-
-                # shim for GREEK ANO TELEIA
-                token = token.replace("·", "·")
-
-                # Handle punctuation
-                punct_token = None
-                if koinenlp.remove_punctuation(token) == token[:-1]:
-                    punct_token = token[-1]
-                    end_token = token[:-1]
-                else:
-                    end_token = token
-
-                # Output only the normalized form
-                if self.task == "compare":
-                    self.out_lines.append(self.unicode_normalize(end_token))
-                    if punct_token:
-                        self.out_lines.append(punct_token)
-                elif self.task == "convert":
-                    out_line = OUTLINE.format(self.current_book,
-                                              self.current_chapter,
-                                              self.current_verse,
-                                              self.unicode_normalize(token))
-                    self.out_lines.append(out_line)
+            return
+
+        # Only text in the book, outside headers and notes, is output;
+        # whitespace between elements holds no tokens
+        if (not self.in_book or self.in_note or self.in_header
+                or data.isspace()):
+            return
+
+        # The location changes far less often than the tokens, so
+        # only re-encode the line prefix when it has moved on
+        key = (self.current_book, self.current_chapter, self.current_verse)
+        if key != self.prefix_key:
+            self.prefix_key = key
+            self.prefix_bytes = PREFIX.format(*key).encode('utf-8')
+
+        # Work from locals inside the loop; lb_token is stored back
+        # once the text is exhausted
+        convert = self.task == "convert"
+        out_buf = self.out_buf
+        token_cache = self.token_cache
+        process_token = self.process_token
+        prefix_bytes = self.prefix_bytes
+        lb_token = self.lb_token
+
+        tokens = data.split()
+        for token in tokens:
+
+            # If the given token ends with a hyphen, assume a
+            # token split by a linebreak.  Store it in
+            # lb_token and continue to the next iteration
+            if token[-1] == "-":
+                lb_token = token[:-1]
+                continue
+
+            # If there is a lb_token (from a line-break) waiting,
+            # prepend it to the current token before processing
+            if lb_token:
+                token = lb_token + token
+                lb_token = None
+
+            # Only process a token the first time it is seen
+            encoded = token_cache.get(token)
+            if encoded is None:
+                encoded = token_cache[token] = process_token(token)
+
+            if encoded:
+                if convert:
+                    out_buf += prefix_bytes
+                out_buf += encoded
+
+        self.lb_token = lb_token
+
+        if len(out_buf) >= FLUSH_SIZE:
+            self.flush()
 
     def endElement(self, name):
         "Actions for encountering closed tags"
 
-        if name == "text":
-            self.in_book = False
-            
-        elif name == "head":
-            self.in_header = False
-
-        elif name == "idno":
-            self.in_idno = False
-
-        elif name == "titleStmt":
-            self.in_titlestmt = False
-
-        elif name == "title":
-            self.in_title = False
-
-        elif name == "note":
+        if name == "note":
             self.note_depth -= 1
             if self.note_depth < 1:
                 self.in_note = False
 
+        else:
+            flag = _ELEMENT_FLAGS.get(name)
+            if flag is not None:
+                setattr(self, flag, False)
+
+    def flush(self):
+        "Write out and empty the output buffer"
+
+        # The header, and so the book ID and title, precede any text
+        if self.out_fd is None:
+            if self.outfile:
+                dest = get_filename(self.current_book, self.book_title)
+                self.out_fd = os.open(dest,
+                                      os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                      0o666)
+            else:
+                sys.stdout.flush()
+                self.out_fd = sys.stdout.fileno()
+
+        # The output is already encoded, so skip the io stack entirely
+        written = 0
+        with memoryview(self.out_buf) as view:
+            while written < len(view):
+                written += os.write(self.out_fd, view[written:])
+        self.out_buf.clear()
+
     def endDocument(self):
         "Finish up"
 
-        # Write output to file
+        self.flush()
         if self.outfile:
-            dest = get_filename(self.current_book, self.book_title)
-            f = open(dest, 'w')
-            f.writelines(self.out_lines)
-            f.close()
-        else:
-            for out_line in self.out_lines:
-                print(out_line)
+            os.close(self.out_fd)
+
+def parse(path, task, outfile):
+    "Parse the given volume, feeding its events to a SweteLXX handler"
+
+    handler = SweteLXX(task, outfile)
+
+    # Text is only complete once the parser has moved past it, so an
+    # element's text (or tail) is held back until the next event.
+    pending = None
+    pending_tail = False
+
+    # Namespaced tag to interned local name, so comparisons against the
+    # names the handler knows are identity checks
+    local_names = {}
+
+    # Let the parser read the volume straight from the page cache
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as vol:
+        for event, elem in etree.iterparse(vol,
+                                           events=("start", "end",
+                                                   "comment", "pi"),
+                                           huge_tree=True):
+            if pending is not None:
+                data = pending.tail if pending_tail else pending.text
+                if data:
+                    handler.characters(data)
+
+            # Comments and processing instructions only carry a tail,
+            # which is handed over separately from the text before them
+            if event == "comment" or event == "pi":
+                pending = elem
+                pending_tail = True
+                continue
+
+            tag = elem.tag
+            name = local_names.get(tag)
+            if name is None:
+                name = local_names[tag] = sys.intern(tag.rpartition("}")[2])
+
+            if event == "start":
+                handler.startElement(name, elem.attrib)
+                pending = elem
+                pending_tail = False
+
+            else:
+                handler.endElement(name)
+                pending = elem
+                pending_tail = True
+
+                # Drop everything already handled to keep memory flat
+                elem.clear(keep_tail=True)
+                parent = elem.getparent()
+                if parent is not None:
+                    while elem.getprevious() is not None:
+                        del parent[0]
+
+    if pending is not None and pending.tail:
+        handler.characters(pending.tail)
+
+    handler.endDocument()
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(
@@ -207,13 +328,29 @@ if __name__ == "__main__":
     argparser_diff = subs.add_parser("compare",
                                      help="Print normalized comparison text")
     argparser_convert = subs.add_parser("convert", help="Print converted text")
-    argparser.add_argument('--file', metavar='<file.xml>', type=str,
-                           help='Volume to process.')
+    argparser_source = argparser.add_mutually_exclusive_group()
+    argparser_source.add_argument('--file', metavar='<file.xml>', type=str,
+                                  help='Volume to process.')
+    argparser_source.add_argument('--batch', metavar='<glob>', type=str,
+                                  help='Volumes to process in parallel '
+                                  '(requires --outfile).')
     argparser.add_argument('--outfile', action='store_true',
                            help='Output to file.')
 
     args = argparser.parse_args()
-    vol = open(args.file, 'r')
-    parser = xml.sax.make_parser()
-    parser.setContentHandler(SweteLXX(task=args.command, outfile=args.outfile))
-    parser.parse(vol)
+    if args.batch:
+        # Workers sharing stdout would interleave their output
+        if not args.outfile:
+            argparser.error("--batch requires --outfile")
+        files = sorted(glob.glob(args.batch))
+        if not files:
+            argparser.error("no volumes match {0}".format(args.batch))
+
+        # Volumes are independent, so convert one per process
+        process_one = functools.partial(parse, task=args.command,
+                                        outfile=args.outfile)
+        with concurrent.futures.ProcessPoolExecutor() as pool:
+            for _ in pool.map(process_one, files):
+                pass
+    else:
+        parse(args.file, task=args.command, outfile=args.outfile)